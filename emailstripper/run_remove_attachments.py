@@ -1,7 +1,10 @@
 import mailbox
 import email.mime.text
+import email.message
 import email.header
+import email.parser
 import os
+import sys
 import datetime as dt
 import dateutil.parser
 import dateutil.tz
@@ -9,38 +12,198 @@ import re
 import uuid
 import mimetypes
 import hashlib
+import binascii
 import argparse
+import logging
+import concurrent.futures
+import functools
+import tempfile
 import pathlib
 
 tzmapping = {'EDT': dateutil.tz.gettz('America/Detroit'), 'PST': dateutil.tz.gettz('Asia/Manila')}
+date_parser = dateutil.parser.parser()
+header_parser = email.parser.BytesHeaderParser()
+log = logging.getLogger('emailstripper')
+DATE_FORMAT = '%a, %d %b %Y %H:%M:%S %z'
+DATE_FORMAT_NO_TZ = '%a, %d %b %Y %H:%M:%S'
+STORAGE_DATE_FORMAT = '%Y%m%dT%H%M'
+REPLACE_TEXT = 'Attachment "{}" with size {} kB has been removed ({}). Storage filename: {}\r\n'
+WRITE_BUFFER_SIZE = 1 << 20
+DECODE_CHUNK_SIZE = 1 << 16
+# Translation table replacing characters not suitable for a filename
+_FNAME_BAD_TRANS = str.maketrans(dict.fromkeys('<>:"/|?*\t\n\r\0', '-'))
+_EMAIL_RE = re.compile(r'[a-zA-Z0-9._-]+@[a-zA-Z0-9._-]+\.[a-zA-Z0-9_-]+')
+# RFC 2047 encoded words, and a name consisting of only encoded words
+_ENCODED_WORD_RE = re.compile(r'=\?([^?]+)\?([bBqQ])\?([^?]*)\?=')
+_ENCODED_NAME_RE = re.compile(r'\s*(?:=\?[^?]+\?[bBqQ]\?[^?]*\?=\s*)+')
 
-def main(path, size, filename=None):
+def main(path, size, filename=None, verbose=False):
     """Extract, store and remove attachments from all or a single mbox file in path."""
-    iterator = [filename] if filename is not None else os.listdir(path)
-    for filename in iterator:
-        if not filename.endswith('.mbox'):
-            continue
-        count = 0
-        mbox = mailbox.mbox(os.path.join(path, filename))
+    configure_logging(verbose)
+    if filename is not None:
+        process_mbox(path, filename, size)
+        return
+    with os.scandir(path) as entries:
+        filenames = [entry.name for entry in entries if entry.name.endswith('.mbox') and entry.is_file()]
+    # Every mbox file is independent, so process them in parallel
+    with concurrent.futures.ProcessPoolExecutor(initializer=configure_logging, initargs=(verbose,)) as executor:
+        list(executor.map(functools.partial(process_mbox, path, size=size), filenames))
+
+
+def configure_logging(verbose=False):
+    """Configure the emailstripper logger of this process. With verbose, every removed attachment is logged.
+
+    Called by main and by every worker process, so calling it again replaces the handler instead of adding one.
+    """
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+    if sys.stdout is None:
+        # E.g. pythonw, there is nowhere to log to
+        log.addHandler(logging.NullHandler())
+    else:
+        log.addHandler(CollectingStreamHandler(sys.stdout))
+    log.setLevel(logging.DEBUG if verbose else logging.INFO)
+    log.propagate = False
+
+
+class CollectingStreamHandler(logging.StreamHandler):
+    """StreamHandler that collects the formatted records and writes them to the stream at once in flush().
+
+    process_mbox flushes once per mbox, so the lines of parallel worker processes never get mixed up.
+    """
+
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        self.lines = []
+
+    def emit(self, record):
+        try:
+            self.lines.append(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.lines:
+                self.stream.write(''.join(self.lines))
+                self.lines.clear()
+            super().flush()
+        finally:
+            self.release()
+
+
+def process_mbox(path, filename, size):
+    """Extract, store and remove attachments from a single mbox file in path."""
+    if not filename.endswith('.mbox'):
+        return
+    mbox_path = os.path.join(path, filename)
+    # The folder itself is created when the first attachment is stored
+    attach_dir = pathlib.Path(path) / (filename.removesuffix('.mbox') + ' attachments')
+    try:
+        mbox = mailbox.mbox(mbox_path, create=False)
         mbox.lock()
         try:
-            for key, msg in mbox.items():
-                msg_date = msg['Date']
-                msg_from = msg['From']
+            count = rewrite_mbox(mbox, mbox_path, attach_dir, size)
+        finally:
+            mbox.close()
+        log.info('Removed {} attachments from {}.'.format(count, filename))
+    finally:
+        # Write out the log of this mbox in one go
+        for handler in log.handlers:
+            handler.flush()
+
+
+def rewrite_mbox(mbox, mbox_path, attach_dir, size):
+    """Remove attachments from all messages in a locked mbox and write the result to a new mbox file.
+
+    The new file is only created at the first message with removed attachments, the messages before it are copied
+    at once. After that, unmodified messages are copied byte for byte from the original file and only modified
+    messages are serialized again. The new file replaces the original one when all messages are written.
+    """
+    count = 0
+    dst = None
+    tmp_path = None
+    try:
+        with open(mbox_path, 'rb') as src:
+            for key in sorted(mbox.keys()):
+                start, stop = mbox._toc[key]
+                msg = None
                 count_before = count
-                count = walk_over_parts(msg, count, path, filename, msg_date, msg_from, size)
+                # Only parse messages that can contain attachments, one at a time
+                if may_contain_attachments(src, start, stop):
+                    msg = mbox.get_message(key)
+                    count = walk_over_parts(msg, count, attach_dir, msg, size)
                 if count > count_before:
-                    mbox.__setitem__(key, msg)
+                    if dst is None:
+                        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(mbox_path),
+                                                        prefix=os.path.basename(mbox_path), suffix='.tmp')
+                        dst = os.fdopen(fd, 'wb', buffering=WRITE_BUFFER_SIZE)
+                        copy_range(src, dst, 0, start)
+                    dst.write(b'From ' + msg.get_from().encode('ascii') + mailbox.linesep)
+                    mbox._dump_message(msg, dst, mbox._mangle_from_)
+                    mbox._post_message_hook(dst)
+                elif dst is not None:
+                    copy_range(src, dst, start, stop)
+                    mbox._post_message_hook(dst)
+        if dst is None:
+            return count
+        dst.flush()
+        os.fsync(dst.fileno())
+        dst.close()
+        os.chmod(tmp_path, os.stat(mbox_path).st_mode)
+        # Like mailbox's own flush, close the mbox file before replacing it, Windows can't replace an open file
+        mbox._file.close()
+        try:
+            os.replace(tmp_path, mbox_path)
         finally:
-            mbox.flush()
-            mbox.close()
-        print('Removed {} attachments from {}.'.format(count, filename))
+            mbox._file = open(mbox_path, 'rb+')
+            if mbox._locked:
+                mailbox._lock_file(mbox._file, dotlock=False)
+    finally:
+        if dst is not None:
+            dst.close()
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return count
+
+
+def copy_range(src, dst, start, stop):
+    """Copy the bytes between start and stop in file src to file dst."""
+    src.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        buffer = src.read(min(WRITE_BUFFER_SIZE, remaining))
+        if not buffer:
+            break
+        dst.write(buffer)
+        remaining -= len(buffer)
 
 
-def walk_over_parts(parent, count, path, filename, msg_date, msg_from, size):
+def may_contain_attachments(src, start, stop):
+    """Return whether the message between start and stop in the mbox file src can contain attachments.
+
+    Only the headers are read. Like walk_over_parts, this accepts multipart messages and message/rfc822 wrappers.
+    """
+    src.seek(start)
+    src.readline()  # Skip the From line
+    lines = []
+    while src.tell() < stop:
+        line = src.readline()
+        # The headers end at the first empty line, exactly like in the email feedparser. A whitespace-only line is a
+        # header continuation there, so stopping on it could hide the Content-Type and skip a message with attachments.
+        if line in (b'\n', b'\r\n'):
+            break
+        lines.append(line)
+    headers = header_parser.parsebytes(b''.join(lines))
+    return headers.get_content_maintype() in ('multipart', 'message')
+
+
+def walk_over_parts(parent, count, attach_dir, msg, size):
     """Walk over the parts of a parent and try to remove attachments.
     
     This function works recursive. So parent is a message, or a part of a message, or a subpart of a part, etc.
+    msg is the message containing parent, its headers are only read when an attachment is actually stored.
     """
     if not parent.is_multipart():
         return count
@@ -48,104 +211,221 @@ def walk_over_parts(parent, count, path, filename, msg_date, msg_from, size):
         if part.get_content_type() in ["text/plain", "text/html"]:
             continue
         if part.is_multipart():
-            count = walk_over_parts(part, count, path, filename, msg_date, msg_from, size)
+            count = walk_over_parts(part, count, attach_dir, msg, size)
             continue
-        content_size, attachment_name = parse_attachment(part)
-        if content_size is not None and content_size > size:
-            print('Removing attachment {} with size {:.0f} kB.'.format(attachment_name, content_size / 1e3))
-            store_filename = store_attachment(part, attachment_name, filename, path, msg_date, msg_from)
-            payload = parent.get_payload()
-            payload[i] = get_replace_text(attachment_name, store_filename, content_size)
-            parent.set_payload(payload)
+        content_size, attachment_name = parse_attachment(part, size)
+        if content_size is not None:
+            log.debug('Removing attachment {} with size {} kB.'.format(attachment_name, content_size // 1000))
+            store_filename = store_attachment(part, attachment_name, attach_dir, msg)
+            # get_payload() returns the list of parts itself, so this replaces the part in place
+            parent.get_payload()[i] = get_replace_text(attachment_name, store_filename, content_size)
             count += 1
     return count
 
 
-def parse_attachment(part):
-    """Parse the message part and find whether it's an attachment."""
+def parse_attachment(part, size):
+    """Parse the message part and find whether it's an attachment larger than size."""
     if not part.get_content_disposition() in ['inline', 'attachment']:
         return None, None
+    # Use the internal payload string, get_payload() copies it just to check for surrogates
+    content = part._payload
+    assert type(content) is str
+    content_size = len(content)
+    if content_size <= size:
+        return None, None
     attachment_name = part.get_filename()
     if attachment_name is not None:
-        attachment_name, encoding = email.header.decode_header(attachment_name)[0]
-        if encoding is not None and attachment_name is not None:
-            attachment_name = attachment_name.decode(encoding)
+        attachment_name = decode_attachment_name(attachment_name)
     if attachment_name is None:
         attachment_name = create_default_name(part)
     if attachment_name is None:
         return None, None
     if attachment_name.endswith('.eml'):
-        print('Storing .eml files not supported, skipping {}.'.format(attachment_name))
+        log.info('Storing .eml files not supported, skipping {}.'.format(attachment_name))
         return None, None
-    content = part.get_payload()
-    assert type(content) is str
-    content_size = len(content)
     return content_size, attachment_name
 
 
+def decode_attachment_name(attachment_name):
+    """Decode the RFC 2047 encoded words in an attachment name."""
+    if '=?' not in attachment_name:
+        return attachment_name
+    if _ENCODED_NAME_RE.fullmatch(attachment_name):
+        words = _ENCODED_WORD_RE.findall(attachment_name)
+        charsets = {charset.lower() for charset, _, _ in words}
+        if len(charsets) == 1:
+            content = b''.join(decode_encoded_word(encoding, text) for _, encoding, text in words)
+            return content.decode(charsets.pop())
+    # Mixed charsets or unencoded text around the encoded words
+    return str(email.header.make_header(email.header.decode_header(attachment_name)))
+
+
+def decode_encoded_word(encoding, text):
+    """Return the bytes of the text of an RFC 2047 encoded word."""
+    if encoding in 'bB':
+        return binascii.a2b_base64(text + '=' * (-len(text) % 4))
+    return binascii.a2b_qp(text, header=True)
+
+
 def create_default_name(part):
-    for tup in part._headers:
-        if tup[0] == 'Content-Type':
-            extension = mimetypes.guess_extension(tup[1])
-            if extension is not None:
-                return part.get_content_disposition() + '-' + str(uuid.uuid4()) + extension
-            # Use .bin if no match is found
-            return part.get_content_disposition() + '-' + str(uuid.uuid4()) + '.bin'
-
-
-def store_attachment(part, attachment_name, filename, base_path, msg_date, msg_from):
-    """Store an attachement as a file on disk."""
-    store_filename = get_storage_filename(attachment_name, msg_date, msg_from)
-    store_folder = filename.rstrip('.mbox') + ' attachments'
-    path = os.path.join(base_path, store_folder)
-    if not os.path.exists(path):
-        os.makedirs(path)
-    # Prevent overwriting files of same name at same time
-    content = part.get_payload(decode=True)
-    if os.path.exists(os.path.join(path, store_filename)):
-        md5_hash = hashlib.md5()
-        md5_hash.update(content)
-        store_filename = md5_hash.hexdigest()+" "+store_filename
-    with open(os.path.join(path, store_filename), 'wb') as f:
-        f.write(content)
+    if part.get('Content-Type') is None:
+        return None
+    return part.get_content_disposition() + '-' + uuid.uuid4().hex + guess_extension(part.get_content_type())
+
+
+@functools.lru_cache(maxsize=256)
+def guess_extension(content_type):
+    # Use .bin if no match is found
+    return mimetypes.guess_extension(content_type) or '.bin'
+
+
+def store_attachment(part, attachment_name, attach_dir, msg):
+    """Store an attachement as a file in the folder attach_dir."""
+    store_filename = get_storage_filename(attachment_name, msg['Date'], msg['From'])
+    try:
+        f = create_file(attach_dir / store_filename)
+    except FileExistsError:
+        # Prevent overwriting files of same name at same time. The content hash is only known after writing, so
+        # write to a new file with a unique name first; create_file never opens an existing file.
+        tmp_path = attach_dir / (uuid.uuid4().hex + '.part')
+        try:
+            with create_file(tmp_path) as f:
+                content_hash = write_payload(part, f, new_content_hash)
+            store_filename = content_hash.hexdigest()+" "+store_filename
+            os.replace(tmp_path, attach_dir / store_filename)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    else:
+        with f:
+            write_payload(part, f)
     return store_filename
 
 
+def create_file(file_path):
+    """Create and open a new file for writing, creating its folder if needed.
+
+    Raises FileExistsError if the file already exists, so no separate check is needed.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    try:
+        fd = os.open(file_path, flags, 0o666)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        fd = os.open(file_path, flags, 0o666)
+    return os.fdopen(fd, 'wb', buffering=WRITE_BUFFER_SIZE)
+
+
+def write_payload(part, f, new_hash=None):
+    """Write the decoded payload of a part to the binary file object f.
+
+    If new_hash is given, e.g. new_content_hash, the content is hashed while writing and the hash object is returned.
+    """
+    hash_obj = new_hash() if new_hash is not None else None
+    try:
+        for chunk in iter_payload_chunks(part):
+            f.write(chunk)
+            if hash_obj is not None:
+                hash_obj.update(chunk)
+    except (binascii.Error, UnicodeEncodeError):
+        # Malformed base64, let the email package do its lenient decoding instead
+        content = part.get_payload(decode=True)
+        f.seek(0)
+        f.truncate()
+        f.write(content)
+        if hash_obj is not None:
+            hash_obj = new_hash()
+            hash_obj.update(content)
+    return hash_obj
+
+
+def new_content_hash():
+    """Return a hash object for identifying attachment content, BLAKE2b is faster than MD5 on 64-bit CPUs."""
+    return hashlib.blake2b(digest_size=16)
+
+
+def iter_payload_chunks(part, chunk_size=DECODE_CHUNK_SIZE):
+    """Yield the decoded payload of a part in chunks, without decoding it in memory all at once."""
+    if part.get('Content-Transfer-Encoding', '').strip().lower() != 'base64':
+        yield part.get_payload(decode=True)
+        return
+    content = part.get_payload()
+    rest = b''
+    for start in range(0, len(content), chunk_size):
+        data = rest + ''.join(content[start:start + chunk_size].split()).encode('ascii')
+        # base64 decodes in groups of 4 characters, keep the remainder for the next window
+        cut = len(data) - len(data) % 4
+        rest = data[cut:]
+        if cut:
+            yield binascii.a2b_base64(data[:cut])
+    if rest:
+        yield binascii.a2b_base64(rest)
+
+
 def get_storage_filename(attachment_name, msg_date, msg_from):
     """Return a string that can be used as filename for storing the attachment."""
+    date_str = get_date_string(msg_date)
+    # Assume there is an email address in there:
+    from_address = get_from_address(msg_from)
+    res = '{} from-{} {}'.format(date_str, from_address, attachment_name)
+    # Replace characters not suitable for a filename:
+    return res.translate(_FNAME_BAD_TRANS)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_date_string(msg_date):
+    """Parse a Date header and return it formatted for a storage filename.
+
+    Cached, because the same Date header is parsed for every attachment of a message.
+    """
     try:
         if "(" in msg_date:
-            print("Removing parentheses from date entry: {}".format(msg_date))
+            log.info("Removing parentheses from date entry: {}".format(msg_date))
             msg_date = msg_date.split(" (")[0]
-        date = dt.datetime.strptime(msg_date, '%a, %d %b %Y %H:%M:%S %z')
+        date = dt.datetime.strptime(msg_date, DATE_FORMAT)
     except ValueError:
         try:
-            date = dateutil.parser.parse(msg_date, tzinfos=tzmapping)
+            date = date_parser.parse(msg_date, tzinfos=tzmapping)
         except ValueError:
             # Have only encountered this with "+200" in the timezone info
             msg_date = msg_date.split(" +")[0]
             try:
-                date = dt.datetime.strptime(msg_date, '%a, %d %b %Y %H:%M:%S')
+                date = dt.datetime.strptime(msg_date, DATE_FORMAT_NO_TZ)
             except ValueError:
-                date = dateutil.parser.parse(msg_date, tzinfos=tzmapping)
-    date_str = date.strftime('%Y%m%dT%H%M')
-    # Assume there is an email address in there:
-    from_address = re.search(r'([a-zA-Z0-9._-]+@[a-zA-Z0-9._-]+\.[a-zA-Z0-9_-]+)', msg_from).group(0)
-    res = '{} from-{} {}'.format(date_str, from_address, attachment_name)
-    # Replace characters not suitable for a filename:
-    return re.sub(r'[<>:"\/\|\?\*\t\n\r\0]', r'-', res)
+                date = date_parser.parse(msg_date, tzinfos=tzmapping)
+    return date.strftime(STORAGE_DATE_FORMAT)
+
+
+def get_from_address(msg_from):
+    """Return the first email address in a From header."""
+    # Fast path for the common 'Name <address>' form. Only taken if the name has no '@', so the result is always the
+    # first address in the header, like the regex search gives.
+    name, _, rest = msg_from.partition('<')
+    address = rest.partition('>')[0]
+    if '@' not in name and _EMAIL_RE.fullmatch(address):
+        return address
+    return _EMAIL_RE.search(msg_from).group(0)
 
 
 def get_replace_text(attachment_name, store_filename, content_size):
     """Return a message object to replace an attachment with."""
-    return email.mime.text.MIMEText('Attachment "{}" with size {:.0f} kB has been removed ({}). Storage filename: {}\r\n'
-                                    .format(attachment_name, content_size / 1e3, dt.date.today(), store_filename))
+    text = REPLACE_TEXT.format(attachment_name, content_size // 1000, dt.date.today(), store_filename)
+    if not text.isascii():
+        return email.mime.text.MIMEText(text, 'plain', 'utf-8')
+    # Same message as MIMEText would create, without its charset and encoder lookups
+    msg = email.message.Message()
+    msg['Content-Type'] = 'text/plain; charset="us-ascii"'
+    msg['MIME-Version'] = '1.0'
+    msg['Content-Transfer-Encoding'] = '7bit'
+    msg.set_payload(text)
+    return msg
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='run_remove_attachments.py')
     parser.add_argument('-p', '--path', nargs='?', default="C:\\Users\\Frank\\Downloads\\takeout", type=pathlib.Path)
     parser.add_argument('-s', '--size', nargs='?', default=100e3, type=float)
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every removed attachment')
     args = parser.parse_args()
-    main(path = args.path, size = args.size)
+    main(path = args.path, size = args.size, verbose = args.verbose)
 
@@ -1,24 +1,32 @@
 import mailbox
 import os
+import concurrent.futures
+import functools
 
 
 def main(path):
     """Remove messages from a mbox files in path that were in Trash in Gmail."""
-    for filename in os.listdir(path):
-        if not filename.endswith('.mbox'):
-            continue
-        count = 0
-        mbox = mailbox.mbox(os.path.join(path, filename))
-        mbox.lock()
-        try:
-            for key, msg in mbox.items():
-                if 'Trash' in msg.get('X-Gmail-Labels'):
-                    mbox.remove(key)
-                    count += 1
-        finally:
-            mbox.flush()
-            mbox.close()
-        print('Removed {} messages from {}.'.format(count, filename))
+    with os.scandir(path) as entries:
+        filenames = [entry.name for entry in entries if entry.name.endswith('.mbox') and entry.is_file()]
+    # Every mbox file is independent, so process them in parallel
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        list(executor.map(functools.partial(process_mbox, path), filenames))
+
+
+def process_mbox(path, filename):
+    """Remove messages from a single mbox file in path that were in Trash in Gmail."""
+    count = 0
+    mbox = mailbox.mbox(os.path.join(path, filename))
+    mbox.lock()
+    try:
+        for key, msg in mbox.items():
+            if 'Trash' in msg.get('X-Gmail-Labels'):
+                mbox.remove(key)
+                count += 1
+    finally:
+        mbox.flush()
+        mbox.close()
+    print('Removed {} messages from {}.'.format(count, filename))
 
 
 if __name__ == '__main__':